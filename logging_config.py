@@ -78,6 +78,10 @@ def logging_config(debug: list[str] = None) -> dict:
                 "level": "DEBUG" if debug == [""] else "INFO",
                 "propagate": False,
             },
+            # httpx logs every request at INFO
+            "httpx": {
+                "level": "DEBUG" if debug == [""] else "WARNING",
+            },
             **{
                 name: {
                     "handlers": ["debug", "info", "warning", "error", "critical"],
@@ -1,22 +1,75 @@
 #!/usr/bin/env python
 
 import argparse
+import codecs
+import concurrent.futures
+import contextlib
 import json
 import logging
 import logging.config
 import os
 import re
-import shutil
-from urllib.parse import unquote
+import time
+from urllib.parse import unquote, urlparse
 
-import requests
+import httpx
 
 from logging_config import logging_config
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 MODSJSON = "mods.json"
+MAX_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUS_CODES = {502, 503, 504}
+
+# HTTP/2 multiplexes all requests to a host over a single connection
+SESSION = httpx.Client(
+    headers={"User-Agent": "tunaflsh/external-mods-manager"},
+    follow_redirects=True,
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    # the read timeout applies per chunk, so it also bounds a stalled download
+    timeout=httpx.Timeout(10.0, read=60.0),
+)
+
+
+def send_request(
+    method: str, url: str, stream: bool = False, **kwargs
+) -> httpx.Response:
+    """
+    Sends a request on SESSION, retrying transport errors (connection
+    failures, timeouts) and 502/503/504 responses with exponential backoff.
+
+    Returns:
+        httpx.Response: the response, with the body already read unless
+            stream is True
+    """
+    for attempt in range(RETRIES + 1):
+        delay = RETRY_BACKOFF * 2**attempt
+        response = None
+        try:
+            response = SESSION.send(
+                SESSION.build_request(method, url, **kwargs), stream=True
+            )
+            if response.status_code not in RETRY_STATUS_CODES or attempt == RETRIES:
+                if not stream:
+                    response.read()
+                return response
+        except httpx.TransportError:
+            if response is not None:
+                response.close()
+            if attempt == RETRIES:
+                raise
+        else:
+            response.close()
 
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "tunaflsh/external-mods-manager"})
+        time.sleep(delay)
 
 
 def main():
@@ -36,7 +89,7 @@ def main():
 
     logger = logging.getLogger()
 
-    modlist = json.load(open(MODSJSON, "r"))
+    modlist = load_modlist()
     version = modlist["version"]
 
     disabled_mods = [mod for mod in modlist["mods"] if mod.get("disabled")]
@@ -49,98 +102,262 @@ def main():
         version,
     )
 
+    # list the directory once instead of checking every file separately
+    existing_files = set(os.listdir())
+
     if removing_mods:
         logger.info(
             "Removing %s",
             f"{len(removing_mods)} mods" if len(removing_mods) > 1 else "1 mod",
         )
         for mod in removing_mods:
-            if os.path.exists(mod["file"]):
+            if mod["file"] in existing_files:
                 os.remove(mod["file"])
+                existing_files.discard(mod["file"])
             del mod["file"]
 
     extractors = [
-        extractor_factory(mod["name"], version, mod["source"], mod.get("file"))
+        extractor_factory(
+            mod["name"],
+            version,
+            mod["source"],
+            mod.get("file"),
+            mod.get("etag"),
+            mod.get("mod_list"),
+            existing_files,
+        )
         for mod in enabled_mods
     ]
 
-    mods = {}
+    # fetch the releases of all github repos in one request if possible
+    releases = GithubBatchFetcher(os.environ.get("GITHUB_TOKEN")).fetch(
+        [
+            extractor.source
+            for extractor in extractors
+            if isinstance(extractor, GithubReleasesExtractor)
+        ]
+    )
     for extractor in extractors:
-        mods[extractor.name] = {
-            "name": extractor.name,
-            "source": extractor.source,
-        }
-        if extractor.download_jar():
-            mods[extractor.name]["version"] = extractor.version
-            mods[extractor.name]["file"] = extractor.file
-
-    modlist["mods"] = list(mods.values()) + disabled_mods
-    json.dump(modlist, open(MODSJSON, "w"), indent=4)
+        if isinstance(extractor, GithubReleasesExtractor):
+            extractor.releases = releases.get(extractor.source)
+
+    # the work is I/O-bound, so the extractors run concurrently in threads
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(MAX_WORKERS, len(extractors)) or 1
+    ) as executor:
+        futures = [executor.submit(extractor.download_jar) for extractor in extractors]
+
+    mods = []
+    for extractor, future in zip(extractors, futures):
+        mod = {"name": extractor.name, "source": extractor.source}
+        if future.result():
+            mod["version"] = extractor.version
+            mod["file"] = extractor.file
+        if extractor.etag:
+            mod["etag"] = extractor.etag
+            mod["mod_list"] = extractor.mod_list
+        mods.append(mod)
+
+    modlist["mods"] = mods + disabled_mods
+    save_modlist(modlist)
 
     logger.info("Done!")
 
 
+def load_modlist() -> dict:
+    with open(MODSJSON, "rb") as f:
+        return orjson.loads(f.read()) if orjson else json.load(f)
+
+
+def save_modlist(modlist: dict):
+    # always written by json: orjson can only indent by 2 spaces, which would
+    # reformat the hand-edited file whenever orjson happens to be installed
+    data = json.dumps(modlist, indent=4, ensure_ascii=False).encode() + b"\n"
+
+    # write and sync a temporary file first, so a crash or power loss never
+    # leaves a truncated mods.json (and its cached ETags) behind
+    tmp = f"{MODSJSON}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, MODSJSON)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def extractor_factory(
-    name: str, version: str, source: str, file: str = None
+    name: str,
+    version: str,
+    source: str,
+    file: str = None,
+    etag: str = None,
+    mod_list: dict[str, str] = None,
+    existing_files: set[str] = None,
 ) -> "ModExtractor":
     if name == "SeedcrackerX":
-        return SeedcrackerXExtractor(version, source, file)
+        return SeedcrackerXExtractor(
+            version, source, file, etag, mod_list, existing_files
+        )
     else:
-        return GithubReleasesExtractor(name, version, source, file)
+        return GithubReleasesExtractor(
+            name, version, source, file, etag, mod_list, existing_files
+        )
+
+
+def parse_github_source(source: str) -> tuple[str, str]:
+    """
+    Returns:
+        tuple[str, str]: the owner and repo of a [https://]github.com/owner/repo[.git] url
+    """
+    if "://" not in source:
+        source = f"https://{source}"
+
+    owner, repo = urlparse(source).path.strip("/").removesuffix(".git").split("/", 1)
+    return owner, repo
 
 
 class ModExtractor:
-    GITHUB_REGEX = re.compile(
-        r"^(https?://)?github.com/(?P<owner>.+?)/(?P<repo>.+?)(\.git)?$"
+    # RFC 5987 extended filename: filename*=charset'language'percent-encoded
+    EXT_FILENAME_REGEX = re.compile(
+        r"filename\*=(?P<charset>[\w-]*)'[\w-]*'(?P<filename>[^;\s]+)", re.IGNORECASE
     )
+    FILENAME_REGEX = re.compile(r"filename=\"?(?P<filename>[^\";]+)\"?", re.IGNORECASE)
 
-    def __init__(self, name: str, version: str, source: str, file: str = None):
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        source: str,
+        file: str = None,
+        etag: str = None,
+        mod_list: dict[str, str] = None,
+        existing_files: set[str] = None,
+    ):
         self.name = name
         self.version = version
         self.source = source
         self.file = file
+        self.etag = etag
+        self.mod_list = mod_list
+        # the files in the working directory, shared between the extractors
+        self.existing_files = (
+            set(os.listdir()) if existing_files is None else existing_files
+        )
         self.logger = logging.getLogger(self.name)
 
     def __repr__(self) -> str:
         return self.name
 
-    def extract_jars(self, response: requests.Response) -> dict[str, str]:
+    def extract_jars(self, response: httpx.Response) -> dict[str, str]:
         return None
 
+    def _cached_fetch(self, url: str) -> httpx.Response:
+        """
+        Sends If-None-Match with the ETag of the cached mod_list, so GitHub
+        can answer with 304 Not Modified instead of the full payload.
+
+        Returns:
+            httpx.Response: status 304 if the cached mod_list is still valid
+        """
+        headers = {"If-None-Match": self.etag} if self.etag and self.mod_list else {}
+        return send_request("GET", url, headers=headers)
+
+    @staticmethod
+    def _ends_with_version(text: str, version: str) -> bool:
+        # version at the end of text, optionally followed by one non-digit,
+        # and not preceded by a digit
+        for end in (len(text), len(text) - 1):
+            start = end - len(version)
+            if (
+                start >= 0
+                and text[start:end] == version
+                and not text[end:].isdigit()
+                and not text[start - 1 : start].isdigit()
+            ):
+                return True
+        return False
+
+    @staticmethod
+    def _contains_version(text: str, version: str) -> bool:
+        # version anywhere in text, not preceded by a digit
+        start = text.find(version)
+        while start != -1:
+            if not text[start - 1 : start].isdigit():
+                return True
+            start = text.find(version, start + 1)
+        return False
+
     def find_matching_version(self, mod_list: dict[str, str]) -> str:
         # try to find the exact VERSION a.b.c then a.b.* then a.b
+        if self.version in mod_list:
+            self.logger.debug("Exact version found: %s", self.version)
+            return self.version
+
         versions = [
             version
             for version in mod_list
-            if re.search(rf"(^|\D){self.version}($|\D)$", version)
+            if self._ends_with_version(version, self.version)
         ]
         if len(versions) > 1:
-            self.logger.error(f"More than one version found: {versions}")
+            self.logger.error("More than one version found: %s", versions)
             return None
 
         if versions:
-            self.logger.debug(f"Exact version found: {versions[0]}")
+            self.logger.debug("Exact version found: %s", versions[0])
             return versions[0]
 
         a, b, c = self.version.split(".")
         versions = [
-            version for version in mod_list if re.search(rf"(^|\D){a}\.{b}\.", version)
+            version
+            for version in mod_list
+            if self._contains_version(version, f"{a}.{b}.")
         ]
         if len(versions) > 1:
-            self.logger.error(f"More than one version found: {versions}")
+            self.logger.error("More than one version found: %s", versions)
             return None
 
         if versions:
-            self.logger.warning(f"No exact version found. Using: {versions[0]}")
+            self.logger.warning("No exact version found. Using: %s", versions[0])
             return versions[0]
 
         if f"{a}.{b}" in mod_list:
-            self.logger.warning(f"No exact version found. Using: {a}.{b}")
+            self.logger.warning("No exact version found. Using: %s.%s", a, b)
             return f"{a}.{b}"
 
-        self.logger.error(f"No matching version found")
+        self.logger.error("No matching version found")
         return None
 
+    def _filename(self, content_disposition: str) -> str:
+        """
+        Returns:
+            str: the filename of a Content-Disposition header, preferring
+                filename* over filename as RFC 6266 requires, with any path
+                information removed
+        """
+        filename = self.EXT_FILENAME_REGEX.search(content_disposition)
+        if filename:
+            try:
+                charset = codecs.lookup(filename["charset"] or "utf-8").name
+            except LookupError:
+                charset = "utf-8"
+            file = unquote(filename["filename"], encoding=charset)
+        else:
+            filename = self.FILENAME_REGEX.search(content_disposition)
+            if not filename:
+                return None
+            file = unquote(filename["filename"])
+
+        # never let the server choose a path outside the mods directory
+        file = os.path.basename(file.strip().replace("\\", "/"))
+        if file in ("", ".", ".."):
+            return None
+
+        return file
+
     def download_jar(self) -> bool:
         """
         Returns:
@@ -148,59 +365,55 @@ class ModExtractor:
         """
         jars = self.extract_jars()
         if not jars:
-            self.logger.error(f"Failed to extract jars")
+            self.logger.error("Failed to extract jars")
             return False
 
         version = self.find_matching_version(jars)
         if not version:
-            self.logger.error(f"Failed to find matching version")
+            self.logger.error("Failed to find matching version")
             return False
 
         self.version = version
         jar_url = jars[self.version]
 
-        response = SESSION.head(jar_url, allow_redirects=True)
-        if response.status_code != 200:
-            self.logger.error(
-                f"Filename Header: Status Code {response.status_code} from {jar_url}"
-            )
-            return False
-
-        self.logger.debug(f"Filename Header: {len(response.content)} bytes received")
+        # a single streamed GET: the filename comes from the response headers
+        # and the body is only read if the file is not present yet
+        with contextlib.closing(send_request("GET", jar_url, stream=True)) as response:
+            if response.status_code != 200:
+                self.logger.error(
+                    "Download: Status Code %s from %s", response.status_code, jar_url
+                )
+                return False
 
-        content_disposition = response.headers.get("Content-Disposition", "")
+            file = self._filename(response.headers.get("Content-Disposition", ""))
+            if not file:
+                self.logger.error("No filename")
+                return False
 
-        if "filename=" not in content_disposition:
-            self.logger.error(f"No filename")
-            return False
-
-        file = content_disposition.split("filename=")[1].strip('"')
-        file = unquote(file)
-        old_file, self.file = self.file, file
+            old_file, self.file = self.file, file
 
-        if os.path.exists(file):
-            self.logger.info(f"Already up to date")
-            return True
+            if file in self.existing_files:
+                self.logger.info("Already up to date")
+                return True
 
-        self.logger.info(f"Downloading")
+            self.logger.info("Downloading")
 
-        response = SESSION.get(jar_url, stream=True)
-        if response.status_code != 200:
-            self.logger.error(
-                f"Download: Status Code {response.status_code} from {jar_url}"
-            )
-            return False
+            bytes_copied = 0
+            with open(file, "wb") as f:
+                for chunk in response.iter_bytes(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    bytes_copied += len(chunk)
 
-        with open(file, "wb") as f:
-            shutil.copyfileobj(response.raw, f)
+            self.logger.debug("Download: %d bytes received", bytes_copied)
 
-        self.logger.debug(f"Download: {len(response.content)} bytes received")
+        self.existing_files.add(file)
 
-        if old_file and old_file != file and os.path.exists(old_file):
+        if old_file and old_file != file and old_file in self.existing_files:
             os.remove(old_file)
-            self.logger.info(f"Download complete: Updated {old_file} to {file}")
+            self.existing_files.discard(old_file)
+            self.logger.info("Download complete: Updated %s to %s", old_file, file)
         else:
-            self.logger.info(f"Download complete: Saved to {file}")
+            self.logger.info("Download complete: Saved to %s", file)
 
         return True
 
@@ -212,49 +425,57 @@ class SeedcrackerXExtractor(ModExtractor):
     TODO: use the github api instead of scraping the readme
     """
 
+    VERSION_TAB_REGEX = re.compile(r"#+\s+Version Tab\n(.*?)\n#+\s+", re.DOTALL)
+    JAR_ROW_REGEX = re.compile(
+        r"\| +(?P<mc_version>[a-z0-9._-]+?\D?) +\| +\[(?P<mod_version>[0-9.]+?)\]\((?P<jar_url>\S+?)\) +\|"
+    )
+
     def __init__(
         self,
         version: str,
         source: str,
         file: str = None,
+        etag: str = None,
+        mod_list: dict[str, str] = None,
+        existing_files: set[str] = None,
         name: str = "SeedcrackerX",
     ):
-        super().__init__(name, version, source, file)
+        super().__init__(name, version, source, file, etag, mod_list, existing_files)
 
     def extract_jars(self) -> dict[str, str]:
-        owner, repo = self.GITHUB_REGEX.match(self.source).group("owner", "repo")
+        owner, repo = parse_github_source(self.source)
         readme = f"https://raw.githubusercontent.com/{owner}/{repo}/master/README.md"
 
         # download readme file from the github url
-        response = SESSION.get(readme)
+        response = self._cached_fetch(readme)
+        if response.status_code == 304:
+            self.logger.debug("README.md not modified: using cached mod_list")
+            return self.mod_list
+
         if response.status_code != 200:
             self.logger.error(
-                f"Download: Status code {response.status_code} from {readme}"
+                "Download: Status code %s from %s", response.status_code, readme
             )
             return None
 
         # extract the Version Tab table
-        version_tab = re.search(
-            r"#+\s+Version Tab\n(.*?)\n#+\s+", response.text, re.DOTALL
-        )
+        version_tab = self.VERSION_TAB_REGEX.search(response.text)
         if not version_tab:
-            self.logger.error(f"Version Tab not found in README.md")
+            self.logger.error("Version Tab not found in README.md")
             return None
 
-        if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.debug(f"version_tab:\n{version_tab[1]}")
+        self.logger.debug("version_tab:\n%s", version_tab[1])
 
         mod_list = {
             match["mc_version"]: match["jar_url"]
-            for match in re.finditer(
-                r"\| +(?P<mc_version>[a-z0-9._-]+?\D?) +\| +\[(?P<mod_version>[0-9.]+?)\]\((?P<jar_url>\S+?)\) +\|",
-                version_tab[1],
-            )
+            for match in self.JAR_ROW_REGEX.finditer(version_tab[1])
         }
 
         if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.debug(f"mod_list:\n{json.dumps(mod_list, indent=4)}")
+            self.logger.debug("mod_list:\n%s", json.dumps(mod_list, indent=4))
 
+        self.etag = response.headers.get("ETag")
+        self.mod_list = mod_list
         return mod_list
 
 
@@ -267,29 +488,63 @@ class GithubReleasesExtractor(ModExtractor):
         r"^(?P<mod_name>.+?)-(?P<game_version>\d+\.\d+(?:\.\d+)?(?:-pre\w+|-rc\w+)?|\d{2}w\d{2}\w+)-(?P<mod_version>.+?)\.jar$"
     )
 
-    def __init__(self, name: str, version: str, source: str, file: str = None):
-        super().__init__(name, version, source, file)
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        source: str,
+        file: str = None,
+        etag: str = None,
+        mod_list: dict[str, str] = None,
+        existing_files: set[str] = None,
+    ):
+        super().__init__(name, version, source, file, etag, mod_list, existing_files)
+        self.releases = None
 
     def extract_jars(self) -> dict[str, str]:
-        owner, repo = self.GITHUB_REGEX.match(self.source).group("owner", "repo")
+        if self.releases is not None:
+            self.logger.debug("Using releases fetched by GithubBatchFetcher")
+            return self.parse_releases(self.releases)
+
+        owner, repo = parse_github_source(self.source)
         releases_url = f"https://api.github.com/repos/{owner}/{repo}/releases"
 
         # download releases page from the github url
-        response = SESSION.get(releases_url)
+        response = self._cached_fetch(releases_url)
+        if response.status_code == 304:
+            self.logger.debug("Releases not modified: using cached mod_list")
+            return self.mod_list
+
         if response.status_code != 200:
             self.logger.error(
-                f"Download: Status code {response.status_code} from {releases_url}"
+                "Download: Status code %s from %s", response.status_code, releases_url
             )
             return None
 
-        releases = response.json()
+        mod_list = self.parse_releases(response.json())
+        if not mod_list:
+            return None
+
+        self.etag = response.headers.get("ETag")
+        self.mod_list = mod_list
+        return mod_list
+
+    def parse_releases(self, releases: list[dict]) -> dict[str, str]:
         if not releases:
-            self.logger.error(f"No releases found")
+            self.logger.error("No releases found")
             return None
 
         if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug(
-                f"mod_list:\n{json.dumps({asset['name']: asset['browser_download_url'] for release in releases for asset in release['assets']}, indent=4)}"
+                "mod_list:\n%s",
+                json.dumps(
+                    {
+                        asset["name"]: asset["browser_download_url"]
+                        for release in releases
+                        for asset in release["assets"]
+                    },
+                    indent=4,
+                ),
             )
 
         mod_list = {
@@ -301,10 +556,96 @@ class GithubReleasesExtractor(ModExtractor):
         }
 
         if self.logger.isEnabledFor(logging.DEBUG):
-            self.logger.debug(f"mod_list:\n{json.dumps(mod_list, indent=4)}")
+            self.logger.debug("mod_list:\n%s", json.dumps(mod_list, indent=4))
 
         return mod_list
 
 
+class GithubBatchFetcher:
+    """
+    Fetches the releases of many github repos with a single GraphQL request.
+
+    The GraphQL API requires authentication, so nothing is fetched without a
+    token and the extractors fall back to the REST API.
+    """
+
+    GRAPHQL_URL = "https://api.github.com/graphql"
+    RELEASES_QUERY = """
+        {alias}: repository(owner: ${alias}_owner, name: ${alias}_repo) {{
+            releases(first: 30, orderBy: {{field: CREATED_AT, direction: DESC}}) {{
+                nodes {{ releaseAssets(first: 20) {{ nodes {{ name downloadUrl }} }} }}
+            }}
+        }}
+    """
+
+    def __init__(self, token: str = None):
+        self.token = token
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def fetch(self, sources: list[str]) -> dict[str, list[dict]]:
+        """
+        Returns:
+            dict[str, list[dict]]: the releases of each source in the shape of
+                the REST API, for the repos that could be fetched
+        """
+        if not self.token or not sources:
+            return {}
+
+        repos = {
+            f"repo{i}": parse_github_source(source) for i, source in enumerate(sources)
+        }
+        variables = {
+            f"{alias}_{key}": value
+            for alias, (owner, repo) in repos.items()
+            for key, value in (("owner", owner), ("repo", repo))
+        }
+        query = "query({}) {{{}}}".format(
+            ", ".join(f"${variable}: String!" for variable in variables),
+            "".join(self.RELEASES_QUERY.format(alias=alias) for alias in repos),
+        )
+
+        # this request is only an optimization: on any failure the extractors
+        # fall back to the REST API
+        try:
+            response = send_request(
+                "POST",
+                self.GRAPHQL_URL,
+                json={"query": query, "variables": variables},
+                headers={"Authorization": f"bearer {self.token}"},
+            )
+            if response.status_code != 200:
+                self.logger.warning(
+                    "Status code %s from %s", response.status_code, self.GRAPHQL_URL
+                )
+                return {}
+
+            data = response.json().get("data") or {}
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.warning("Request to %s failed: %s", self.GRAPHQL_URL, e)
+            return {}
+
+        releases = {}
+        for alias, source in zip(repos, sources):
+            if not data.get(alias):
+                self.logger.warning("No releases fetched for %s", source)
+                continue
+
+            releases[source] = [
+                {
+                    "assets": [
+                        {
+                            "name": asset["name"],
+                            "browser_download_url": asset["downloadUrl"],
+                        }
+                        for asset in release["releaseAssets"]["nodes"]
+                    ]
+                }
+                for release in data[alias]["releases"]["nodes"]
+            ]
+
+        self.logger.debug("Fetched releases of %d repos", len(releases))
+        return releases
+
+
 if __name__ == "__main__":
     main()